@@ -4,61 +4,168 @@ The generated noise will adjust its volume based on the system's volume setting.
 """
 
 import os
-import numpy as np
+import atexit
+import errno
+import fcntl
+import functools
+import math
+import re
 import subprocess
-import pulsectl
 import time
+import select
+from concurrent.futures import ThreadPoolExecutor
 import signal
 import sys
 import time
 import shutil
 
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+# pulsectl is imported by play_and_adjust_volume() once playback starts
+pulsectl = None
+
 t = time.localtime()
 time_str = f"{t.tm_year}_{t.tm_mon}_{t.tm_mday}_{t.tm_hour}_{t.tm_min}"
 
 
-# This function handles graceful exit when Ctrl+C is pressed.
+# pidfd of the play process we started, so we stop exactly that process
+# even if its PID gets reused
+noise_pidfd = None
+
+
+# Function to stop the noise, killing play if it doesn't exit within timeout
+def stop_noise(timeout=2):
+    global noise_pidfd
+    if noise_pidfd is None:
+        return
+
+    try:
+        signal.pidfd_send_signal(noise_pidfd, signal.SIGTERM)
+        # The pidfd becomes readable once the process has exited
+        if not select.select([noise_pidfd], [], [], timeout)[0]:
+            signal.pidfd_send_signal(noise_pidfd, signal.SIGKILL)
+        os.waitid(os.P_PIDFD, noise_pidfd, os.WEXITED)
+    except (ProcessLookupError, ChildProcessError):
+        pass  # play already exited and was reaped
+    finally:
+        os.close(noise_pidfd)
+        noise_pidfd = None
+
+
+# Stop the noise however the script exits, not only on Ctrl+C
+atexit.register(stop_noise)
+
+
+# This function handles graceful exit when Ctrl+C is pressed or the script
+# is killed.
 def signal_handler(sig, frame):
     print("Exiting gracefully...")
-    subprocess.run("killall play", shell=True)
-    sys.exit(0)
+    sys.exit(0)  # runs stop_noise() through atexit
 
 
 signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
 
 
-# Function to fetch the system's volume and mute status
-def get_system_volume():
-    result = subprocess.run(["amixer", "sget", "Master"], stdout=subprocess.PIPE)
-    output = result.stdout.decode()
-    volume = int(output.split("[")[1].split("%")[0])
-    is_muted = "off" in output
-    return volume, is_muted
+# Keep a single Master mixer handle open, reading it is one ioctl
+# instead of spawning amixer every time
+mixer = None
+if alsaaudio:
+    try:
+        mixer = alsaaudio.Mixer("Master")
+    except alsaaudio.ALSAAudioError:
+        pass
+
+
+# Matches amixer's "[65%] [on]" volume and switch fields. Controls without a
+# mute switch don't print the second field.
+VOLUME_RE = re.compile(rb"\[(\d+)%\](?:.*?\[(on|off)\])?", re.S)
 
 
-# Function to record audio using 'arecord'
+# Function to fetch the system's volume and mute status
+def get_system_volume():
+    if mixer:
+        mixer.handleevents()  # make sure we don't read stale values
+        try:
+            is_muted = mixer.getmute()[0] == 1
+        except alsaaudio.ALSAAudioError:
+            is_muted = False  # Master has no mute switch
+        # pyalsaaudio can't reliably tell whether Master has dB information
+        # (its dB values are left uninitialized when it hasn't), so only the
+        # plain percentage is used. On PulseAudio's Master that already is
+        # PulseAudio's own volume scale.
+        return mixer.getvolume()[0], is_muted
+
+    # -M reports the mapped volume, which is what alsamixer shows the user
+    result = subprocess.run(["amixer", "-M", "sget", "Master"], capture_output=True)
+    match = VOLUME_RE.search(result.stdout)
+    return int(match.group(1)), match.group(2) == b"off"
+
+
+# ioctl request number from linux/fs.h
+FICLONE = 0x40049409
+
+
+# Function to copy a file without going through a userspace buffer.
+# Tries a copy-on-write reflink first (btrfs, xfs), then copy_file_range.
+def copy_file(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        except OSError as e:
+            # Filesystem can't reflink, or the files are on different ones
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL):
+                raise
+
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30):
+                pass
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.ENOSYS):
+                raise
+
+    shutil.copyfile(src, dst)
+
+
+# Runs the archival copies of recordings without holding up the analysis
+archive_pool = ThreadPoolExecutor(max_workers=1)
+
+
+# Function to record audio using 'arecord'.
+# Returns the future of the archival copy, so its errors can be reported.
 def record_audio(duration=10):
     print(f"Recording {duration} seconds of audio...")
-    subprocess.run(f"arecord -d {duration} -f cd data/input.wav", shell=True)
+    subprocess.run(["arecord", "-d", str(duration), "-f", "cd", "data/input.wav"])
     # copy as a record for the future
-    shutil.copy("data/input.wav", f"data/input_{time_str}.wav")
+    return archive_pool.submit(
+        copy_file, "data/input.wav", f"data/input_{time_str}.wav"
+    )
 
 
-# Function to generate a spectrogram from an audio file using SOX
+# Function to start generating a spectrogram from an audio file using SOX.
+# Returns the running process so other work can overlap with it.
 def generate_spectrogram():
     print("Generating spectrogram...")
-    subprocess.run(
-        f"sox data/input.wav -n spectrogram -o data/spectrum.png", shell=True
+    return subprocess.Popen(
+        ["sox", "data/input.wav", "-n", "spectrogram", "-o", "data/spectrum.png"]
     )
 
 
 # Function to fetch audio statistics using SOX
 def fetch_audio_stats():
     print("Fetching audio statistics...")
-    subprocess.run(
-        "sox data/input.wav -n stat -freq 2>&1 | sed -n -e :a -e '1,15!{P;N;D;};N;ba' > data/data.txt",
-        shell=True,
+    result = subprocess.run(
+        ["sox", "data/input.wav", "-n", "stat", "-freq"], stderr=subprocess.PIPE
     )
+    # sox prints the frequency table followed by 15 lines of summary stats,
+    # keep only the table
+    with open("data/data.txt", "wb") as f:
+        f.write(b"\n".join(result.stderr.splitlines()[:-15]) + b"\n")
 
 
 def db_to_linear(dB):
@@ -66,38 +173,90 @@ def db_to_linear(dB):
     return 10 ** (dB / 20)
 
 
-def get_new_volume(volume_percentage, is_muted):
-    volume_adjustment = 0
-    return 0 if is_muted else (volume_percentage / 100.0)
+# PulseVolumeInfo for a volume in thousandths, so each distinct volume level
+# is only built once
+@functools.lru_cache(maxsize=128)
+def get_volume_info(volume_permille, channels):
+    return pulsectl.PulseVolumeInfo(volume_permille / 1000.0, channels=channels)
 
 
-def set_volume(volume_percentage, is_muted, pulse, sox_sink_input):
-    new_volume = get_new_volume(volume_percentage, is_muted)
+# Last volume and mute state sent to PulseAudio, so sending the same state
+# again doesn't cost a round trip
+last_applied_volume = None
+last_applied_muted = None
 
-    new_volume_info = pulsectl.PulseVolumeInfo(
-        new_volume, channels=len(sox_sink_input.volume.values)
+
+def set_volume(volume_percentage, is_muted, pulse, sox_sink_input):
+    global last_applied_volume, last_applied_muted
+
+    # The system volume is passed on as is. With PulseAudio's Master, and with
+    # amixer's mapped volume, it is on the same cubic scale PulseAudio uses.
+    new_volume = 0.0 if is_muted else volume_percentage * 0.01
+    # Both volume sources report whole percents, so a real change is always at
+    # least a 1% step and an exact comparison is enough
+    if (new_volume, is_muted) == (last_applied_volume, last_applied_muted):
+        return
+
+    new_volume_info = get_volume_info(
+        round(new_volume * 1000), len(sox_sink_input.volume.values)
     )
 
     pulse.volume_set(sox_sink_input, new_volume_info)
+    last_applied_volume, last_applied_muted = new_volume, is_muted
+
+
+# Callback for PulseAudio events, returns control from pulse.event_listen()
+def stop_listening(event):
+    raise pulsectl.PulseLoopStop
+
+
+# Check whether a PulseAudio sink input is the stream played by SOX
+def is_sox_sink_input(si):
+    return si.proplist.get("application.name") == "ALSA plug-in [sox]"
+
+
+# Function to find an already playing SOX stream, or None
+def find_sox_sink_input(pulse):
+    return next((si for si in pulse.sink_input_list() if is_sox_sink_input(si)), None)
+
+
+# Function to wait for a new SOX stream to show up in PulseAudio.
+# pulse.event_mask_set() has to be called before starting the play process,
+# otherwise its "new" event could be missed.
+def wait_for_sox_sink_input(pulse, timeout=5):
+    new_indexes = []
+
+    def on_new_sink_input(event):
+        if event.t == pulsectl.PulseEventTypeEnum.new:
+            new_indexes.append(event.index)
+            raise pulsectl.PulseLoopStop
+
+    pulse.event_callback_set(on_new_sink_input)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pulse.event_listen(timeout=deadline - time.monotonic())
+        while new_indexes:
+            try:
+                si = pulse.sink_input_info(new_indexes.pop(0))
+            except pulsectl.PulseIndexError:
+                continue  # stream was already gone again
+            if is_sox_sink_input(si):
+                return si
+    return None
 
 
 # Function to play noise and adjust its volume based on system volume
 def play_and_adjust_volume(mean, standard_deviation, initial_volume_dB):
+    global noise_pidfd, pulsectl
+
+    # Only imported here, so recording and analysis work without PulseAudio
+    import pulsectl
+
     with pulsectl.Pulse("volume-adjuster") as pulse:
         volume_percentage, is_muted = get_system_volume()  # Get initial system volume
 
-        # Give some time in case a previous play command is still lingering
-        time.sleep(0.2)
-
         # Check if the SOX process exists in the pulse audio list
-        sox_sink_input = next(
-            (
-                si
-                for si in pulse.sink_input_list()
-                if si.proplist.get("application.name") == "ALSA plug-in [sox]"
-            ),
-            None,
-        )
+        sox_sink_input = find_sox_sink_input(pulse)
 
         # If the SOX process isn't already playing, start it
         if not sox_sink_input:
@@ -106,23 +265,40 @@ def play_and_adjust_volume(mean, standard_deviation, initial_volume_dB):
 
             # This actually renders the noise using the sox package.
             # Eliminating loud noise at beginning from previous command:
-            #     play -n synth noise band {mean} {standard_deviation} vol {initial_volume_dB}dB > /dev/null 2>&1
-            command = f"play -n trim 0.0 2.0 : synth noise band {mean} {standard_deviation} \
-                        vol {reduced_volume}dB \
-                        > /dev/null 2>&1"  # don't show errors or stdout
-
-            subprocess.Popen(command, shell=True)
-
-            time.sleep(0.2)  # Give time for the new play process to show up
-
-            sox_sink_input = next(
-                (
-                    si
-                    for si in pulse.sink_input_list()
-                    if si.proplist.get("application.name") == "ALSA plug-in [sox]"
-                ),
-                None,
+            #     play -n synth noise band {mean} {standard_deviation} vol {initial_volume_dB}dB
+            command = [
+                "play",
+                "-n",
+                "trim",
+                "0.0",
+                "2.0",
+                ":",
+                "synth",
+                "noise",
+                "band",
+                str(mean),
+                str(standard_deviation),
+                "vol",
+                f"{reduced_volume}dB",
+            ]
+
+            # Listen for new streams before starting play, so we can't miss it
+            pulse.event_mask_set(pulsectl.PulseEventMaskEnum.sink_input)
+            # play stays in our process group, so it still gets SIGHUP when
+            # the terminal closes
+            noise_process = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,  # don't show errors or stdout
+                stderr=subprocess.DEVNULL,
             )
+            try:
+                noise_pidfd = os.pidfd_open(noise_process.pid)
+            except OSError:
+                # stop_noise() can't reach play without a pidfd, stop it here
+                noise_process.kill()
+                noise_process.wait()
+                raise
+            sox_sink_input = wait_for_sox_sink_input(pulse)
 
             if not sox_sink_input:
                 print("Couldn't find sox stream in PulseAudio.")
@@ -134,22 +310,28 @@ def play_and_adjust_volume(mean, standard_deviation, initial_volume_dB):
         # Set the playback volume based on the system volume
         set_volume(volume_percentage, is_muted, pulse, sox_sink_input)
 
-        # Continuously adjust the playback volume based on system volume
+        # Only wake up when a sink changes (e.g. the user touched the volume).
+        # The timeout is a safety net for events missed while we were busy.
+        pulse.event_mask_set(pulsectl.PulseEventMaskEnum.sink)
+        pulse.event_callback_set(stop_listening)
+
+        # Adjust the playback volume whenever the system volume changes
         while True:
+            pulse.event_listen(timeout=2)
             volume_percentage, is_muted = get_system_volume()
             set_volume(volume_percentage, is_muted, pulse, sox_sink_input)
-            time.sleep(0.5)
 
 
 def main():
     # Create data directory if it doesn't exist
     if not os.path.exists("data"):
         os.makedirs("data")
+    archive_copy = None
     if os.path.isfile("data/data.txt"):
         while True:
             user_input = input("Record new audio or use the old one? [r/o]\n")
             if user_input == "r":
-                record_audio()
+                archive_copy = record_audio()
                 break
             elif user_input == "o":
                 print("Using old audio...")
@@ -159,26 +341,44 @@ def main():
                     'You didn\'t type "r" for record or "o" for old. Please try again.'
                 )
     else:
-        record_audio()
+        archive_copy = record_audio()
 
-    # Generate spectrogram and fetch audio statistics
-    generate_spectrogram()
+    # Generate spectrogram and fetch audio statistics, both at the same time
+    spectrogram_process = generate_spectrogram()
     fetch_audio_stats()
-
-    # Calculate statistics for noise generation
-    frequency, amplitude = np.loadtxt("data/data.txt", unpack=True)
-    mean_amplitude = np.mean(amplitude)
-    volume_dB = 10 * np.log10(mean_amplitude)
+    spectrogram_process.wait()
+    if archive_copy:
+        archive_copy.result()  # raises if the archival copy failed
+
+    # Calculate statistics for noise generation. The table only has a few
+    # hundred bins, so a single pass in plain Python is all it takes.
+    count = total_amplitude = weighted_sum = weighted_sum_of_squares = 0.0
+    with open("data/data.txt") as f:
+        for line in f:
+            columns = line.split()
+            if not columns:
+                continue
+            frequency, amplitude = float(columns[0]), float(columns[1])
+            count += 1
+            total_amplitude += amplitude
+            weighted_sum += amplitude * frequency
+            weighted_sum_of_squares += amplitude * frequency * frequency
 
     # Check if the sum of amplitude is zero
-    if np.sum(amplitude) == 0:
+    if total_amplitude == 0:
         raise ValueError(
             "Error: The microphone was not turned on or there's no audio input signal."
         )
-    else:
-        mean = np.average(frequency, weights=amplitude)
 
-    standard_deviation = np.sqrt(np.average((frequency - mean) ** 2, weights=amplitude))
+    mean_amplitude = total_amplitude / count
+    volume_dB = 10 * math.log10(mean_amplitude)
+
+    # Amplitude weighted mean and standard deviation of the frequency from the
+    # first two moments
+    mean = weighted_sum / total_amplitude
+    second_moment = weighted_sum_of_squares / total_amplitude
+    # max() guards against small negative values from floating point cancellation
+    standard_deviation = math.sqrt(max(0.0, second_moment - mean * mean))
 
     # Print the calculated values
     print("\nMean Frequency:", mean)